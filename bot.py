@@ -5,8 +5,8 @@ ScannerBot — Telegram-бот + WebSocket-сервер.
 """
 from __future__ import annotations
 
-import asyncio, io, logging, os, pathlib, textwrap
-from datetime import datetime, timedelta, timezone
+import asyncio, logging, os, pathlib, re, socket, textwrap, time
+from datetime import timedelta, timezone
 from typing import Final, Set
 
 import websockets
@@ -19,6 +19,8 @@ class Config:
     TOKEN:   Final[str]          = os.getenv("SCANNER_BOT_TOKEN")
     WS_HOST: Final[str]          = "0.0.0.0"
     WS_PORT: Final[int]          = 8765
+    WS_BUF:  Final[int]          = 256 * 1024   # socket/framing буферы
+    WS_MAX:  Final[int]          = 16 * 1024 * 1024  # макс. размер кадра (скан)
     TIMEOUT: Final[int]          = 15
     TZ:      Final[timezone]     = timezone(timedelta(hours=3))
     DIR_IMG: Final[pathlib.Path] = pathlib.Path("scans/images")
@@ -32,14 +34,33 @@ log = logging.getLogger("scanner")
 
 # ───────────── основной класс ─────────────────────────────────────────────
 class ScannerBot:
+    _TAIL_MAX: Final[int] = 4000     # Telegram hard-limit 4096; небольшой запас
+    _SCAN_RE:  Final[re.Pattern] = re.compile(r"^\s*📷?\s*скан\s*$", re.IGNORECASE)
+    _BLANK_RE: Final[re.Pattern] = re.compile(r"^\s*$")
+    # текстовый кадр: клиент (main.dart) игнорирует бинарные сообщения
+    _SCAN_CMD: Final[str] = '{"cmd":"scan"}'
+    # immutable — строим один раз, а не на каждый /start
+    _START_KB: Final[ReplyKeyboardMarkup] = ReplyKeyboardMarkup(
+        [[KeyboardButton("📷 Скан")]], resize_keyboard=True)
+
     def __init__(self, cfg: Config):
         self.cfg    = cfg
-        self.app    = Application.builder().token(cfg.TOKEN).build()
+        self.app    = (Application.builder().token(cfg.TOKEN)
+                       .connection_pool_size(16).pool_timeout(10)
+                       .read_timeout(30).write_timeout(30)
+                       .get_updates_connection_pool_size(2)
+                       .build())
         self.subs:  Set[int] = set()
         self._ws:   websockets.WebSocketServerProtocol | None = None
-        self._img_q: asyncio.Queue[bytes] = asyncio.Queue()
+        self._img_q: asyncio.Queue[bytes] = asyncio.Queue(maxsize=1)
+        self._scan_lock = asyncio.Lock()     # один /scan ждёт картинку за раз
         self._last_file: pathlib.Path | None = None     # description file
+        self._last_fd: int | None = None     # append-fd description (os.write)
+        self._fd_dirty = False               # есть несинхронизированные записи
+        self._tail_str: str = ""             # последние _TAIL_MAX символов файла
+        self._last_header: str = ""          # «✏️ Обновлено …» — раз на ротацию
         self._last_stem: str | None = None   # добавьте в __init__
+        self._last_ts: int = 0               # защита от коллизий имён в 1 мс
 
     # ────────────────── публичный запуск ────────────────────────────────
     async def run(self):
@@ -50,36 +71,56 @@ class ScannerBot:
         self._restore_last_file()
 
         ws_srv = await websockets.serve(self._ws_handler,
-                                        self.cfg.WS_HOST, self.cfg.WS_PORT)
+                                        self.cfg.WS_HOST, self.cfg.WS_PORT,
+                                        max_size=self.cfg.WS_MAX,
+                                        read_limit=self.cfg.WS_BUF,
+                                        write_limit=self.cfg.WS_BUF,
+                                        # PNG уже сжат — deflate лишь жжёт CPU
+                                        compression=None,
+                                        ping_interval=20, ping_timeout=20)
         log.info("WS listening on ws://%s:%d", self.cfg.WS_HOST, self.cfg.WS_PORT)
 
         self._register_handlers()
         await self.app.initialize(), await self.app.start()
+        await self.app.bot.get_me()     # прогрев TLS до первого /scan
         await self.app.updater.start_polling()
         log.info("Bot polling…  Ctrl-C to stop")
 
+        sync_task = asyncio.create_task(self._fsync_loop())
         try:
             await asyncio.Event().wait()
         finally:
+            sync_task.cancel()
             await self.app.updater.stop(); await self.app.stop(); await self.app.shutdown()
             ws_srv.close(); await ws_srv.wait_closed()
 
     # ────────────────── Telegram handlers ───────────────────────────────
     async def _cmd_start(self, u: Update, _):
         self._subs_add(u.effective_chat.id)
-        kb = ReplyKeyboardMarkup([[KeyboardButton("📷 Скан")]], resize_keyboard=True)
-        await u.message.reply_text("Привет! Нажми «📷 Скан» или /scan.", reply_markup=kb)
+        await u.message.reply_text("Привет! Нажми «📷 Скан» или /scan.",
+                                   reply_markup=self._START_KB)
 
     async def _cmd_scan(self, u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat = u.effective_chat.id; self._subs_add(chat)
         note = await u.message.reply_text(f"📸 Ожидаем файл… (≤ {self.cfg.TIMEOUT}s)")
         try:
-            if not await self._ws_send_scan():
-                await note.edit_text("🚫 Сканер не подключён."); return
-            img = await asyncio.wait_for(self._img_q.get(), timeout=self.cfg.TIMEOUT)
-            img_path, des_path = self._save_files(img)
-            await ctx.bot.send_photo(chat, InputFile(io.BytesIO(img), img_path.name),
-                                     caption=f"`{img_path.name}`", parse_mode="Markdown")
+            # сериализуем trigger+ожидание: два /scan подряд не должны
+            # перехватывать чужую картинку
+            async with self._scan_lock:
+                # выбрасываем кадр, оставшийся от /scan, который успел
+                # отвалиться по таймауту — ждать нужно ответ на наш trigger
+                while not self._img_q.empty():
+                    self._img_q.get_nowait()
+                if not await self._ws_send_scan():
+                    await note.edit_text("🚫 Сканер не подключён."); return
+                img = await asyncio.wait_for(self._img_q.get(),
+                                             timeout=self.cfg.TIMEOUT)
+            img_path, des_path, save_task = self._save_files(img)
+            # запись PNG на диск и upload в Telegram — независимые I/O-потоки
+            await asyncio.gather(
+                save_task,
+                ctx.bot.send_photo(chat, InputFile(img, filename=img_path.name),
+                                   caption=f"`{img_path.name}`", parse_mode="Markdown"))
             await note.delete()
         except asyncio.TimeoutError:
             await note.edit_text("⚠️ Фото не пришло.")
@@ -92,24 +133,19 @@ class ScannerBot:
             await u.message.reply_text("❔ Пока нет фотографий для описания.")
             return
 
-        text = u.message.text.strip()
-        if not text:
+        text = (u.message.text or "").strip()
+        if not text:    # фильтр уже отсёк пустые; подстраховка
             return
 
         try:
-            # append
-            with self._last_file.open("a", encoding="utf-8") as f:
-                f.write(text + "\n")
-
-            # read full content
-            full = self._last_file.read_text(encoding="utf-8")
+            # один os.write в O_APPEND — быстрый syscall, пишем прямо в loop:
+            # поток здесь дал бы гонку с os.close() при ротации fd
+            self._append_text(text)
 
-            # Telegram hard-limit 4096; оставим небольшой запас
-            MAX = 4000
-            to_send = full[-MAX:] if len(full) > MAX else full
+            # хвост держим в памяти — без повторного чтения файла
+            self._tail_str = (self._tail_str + text + "\n")[-self._TAIL_MAX:]
             await u.message.reply_text(
-                f"✏️ Обновлено `{self._last_file.name}`:\n"
-                f"{to_send}",
+                self._last_header + self._tail_str,
                 parse_mode="Markdown",
             )
         except Exception as exc:
@@ -120,34 +156,87 @@ class ScannerBot:
         await u.message.reply_text("Неизвестная команда.")
 
     # ────────────────── WebSocket part ─────────────────────────────────
+    def _tune_ws_socket(self, ws: websockets.WebSocketServerProtocol):
+        """Отключает алгоритм Нейгла («{"cmd":"scan"}» уходит без ~40 мс задержки)
+        и расширяет socket-буферы под многомегабайтные кадры со сканами."""
+        sock = ws.transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.cfg.WS_BUF)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.cfg.WS_BUF)
+
     async def _ws_handler(self, ws: websockets.WebSocketServerProtocol):
+        self._tune_ws_socket(ws)
         self._ws = ws; await self._notify_all("🟢 Сканер подключён")
         try:
             async for msg in ws:
-                if isinstance(msg, bytes): await self._img_q.put(msg)
+                if isinstance(msg, bytes):
+                    # в слоте живёт только самый свежий скан
+                    if self._img_q.full(): self._img_q.get_nowait()
+                    self._img_q.put_nowait(msg)
         finally:
             self._ws = None; await self._notify_all("🔴 Сканер отключён")
 
     async def _ws_send_scan(self) -> bool:
         if not self._ws: return False
-        try: await self._ws.send('{"cmd":"scan"}'); return True
+        try: await self._ws.send(self._SCAN_CMD); return True
         except Exception as e: log.warning("WS send error %s", e); return False
 
     # ────────────────── utilities ──────────────────────────────────────
-    def _save_files(self, img: bytes) -> tuple[pathlib.Path, pathlib.Path]:
-        ts = int(datetime.now(self.cfg.TZ).timestamp() * 1000)
+    def _append_text(self, text: str) -> None:
+        """Append одним os.write; fdatasync делает фоновый _fsync_loop."""
+        os.write(self._last_fd, (text + "\n").encode("utf-8"))
+        self._fd_dirty = True
+
+    def _rotate_fd(self, des_path: pathlib.Path) -> None:
+        """Переоткрывает append-fd при смене description-файла."""
+        if self._last_fd is not None:
+            os.close(self._last_fd)
+        self._last_fd = os.open(str(des_path),
+                                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._last_header = f"✏️ Обновлено `{des_path.name}`:\n"
+
+    async def _fsync_loop(self):
+        """Сбрасывает description на диск раз в 500 мс, а не на каждый append."""
+        sync = getattr(os, "fdatasync", os.fsync)   # нет fdatasync на Windows
+        while True:
+            await asyncio.sleep(0.5)
+            fd = self._last_fd
+            if fd is None or not self._fd_dirty:
+                continue
+            self._fd_dirty = False
+            try: await asyncio.to_thread(sync, fd)
+            except OSError: pass    # fd закрыт ротацией между итерациями
+
+    def _save_files(self, img: bytes) \
+            -> tuple[pathlib.Path, pathlib.Path, asyncio.Task]:
+        # два скана в одну миллисекунду не должны перезаписать друг друга
+        ts = max(time.time_ns() // 1_000_000, self._last_ts + 1)
+        self._last_ts = ts
         img_path = self.cfg.DIR_IMG / f"{ts}.png"
         des_path = self.cfg.DIR_DES / f"{ts}.txt"
-        img_path.write_bytes(img)
-        des_path.touch()
-        self._last_stem = str(ts)            # сразу после touch()
+        # запись стартует фоном — вызывающий дожидается её вместе с upload
+        save_task = asyncio.create_task(
+            asyncio.to_thread(img_path.write_bytes, img))
+        self._last_stem = str(ts)
         self._last_file = des_path
-        return img_path, des_path
+        self._rotate_fd(des_path)            # O_CREAT сам создаёт файл
+        self._tail_str = ""
+        return img_path, des_path, save_task
 
     def _restore_last_file(self):
-        files = sorted(self.cfg.DIR_DES.glob("*.txt"))
-        self._last_file = files[-1] if files else None
+        # имена — мс-таймстампы, лексикографический максимум = новейший файл;
+        # один проход scandir вместо сортировки всего каталога
+        last_name: str | None = None
+        for entry in os.scandir(self.cfg.DIR_DES):
+            if entry.name.endswith(".txt") and \
+                    (last_name is None or entry.name > last_name):
+                last_name = entry.name
+        self._last_file = self.cfg.DIR_DES / last_name if last_name else None
         if self._last_file:
+            self._tail_str = self._last_file.read_text(
+                encoding="utf-8")[-self._TAIL_MAX:]
+            self._rotate_fd(self._last_file)
             log.info("last description restored: %s", self._last_file.name)
 
     def _ensure_dirs(self):
@@ -155,11 +244,12 @@ class ScannerBot:
         self.cfg.DIR_DES.mkdir(parents=True, exist_ok=True)
 
     async def _notify_all(self, txt: str):
-        dead = []
-        for cid in self.subs:
-            try: await self.app.bot.send_message(cid, txt)
-            except: dead.append(cid)
-        for cid in dead: self.subs.discard(cid)
+        subs, bot = list(self.subs), self.app.bot
+        results = await asyncio.gather(
+            *(bot.send_message(cid, txt) for cid in subs),
+            return_exceptions=True)
+        for cid, r in zip(subs, results):
+            if isinstance(r, Exception): self.subs.discard(cid)
 
     def _subs_add(self, cid: int): self.subs.add(cid)
 
@@ -167,8 +257,12 @@ class ScannerBot:
         ah = self.app.add_handler
         ah(CommandHandler("start", self._cmd_start))
         ah(CommandHandler("scan",  self._cmd_scan))
-        ah(MessageHandler(filters.Regex("(?i)скан"), self._cmd_scan))
-        ah(MessageHandler(filters.TEXT & ~filters.COMMAND, self._plain_text))
+        # заякоренный и скомпилированный заранее: матчит ровно кнопку
+        # «📷 Скан» / «скан», не сканируя длинные описания целиком
+        ah(MessageHandler(filters.Regex(self._SCAN_RE), self._cmd_scan))
+        # whitespace-only сообщения отсекает фильтр, не тело handler'а
+        ah(MessageHandler(filters.TEXT & ~filters.COMMAND
+                          & ~filters.Regex(self._BLANK_RE), self._plain_text))
         ah(MessageHandler(filters.PHOTO, self._photo))
         ah(MessageHandler(filters.COMMAND, self._cmd_unknown))
 
@@ -194,4 +288,9 @@ class ScannerBot:
 
 # ───────────── entrypoint ────────────────────────────────────────────────
 if __name__ == "__main__":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass    # нет uvloop (например, Windows) — обычный event loop
     asyncio.run(ScannerBot(Config).run())
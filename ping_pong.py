@@ -34,4 +34,9 @@ async def main():
         await app.shutdown()
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass    # нет uvloop (например, Windows) — обычный event loop
     asyncio.run(main())